@@ -1,18 +1,18 @@
 #!/usr/bin/env python3
 
 import asyncio
-import configparser
 import logging
 import discord
 import os
 import pprint
 import random
+import re
 import sys
 import traceback
 import time
 
 from pathlib import Path
-from typing import Any, cast, Coroutine, List, Dict, Optional, Callable, Tuple, Union
+from typing import Any, cast, Coroutine, List, Dict, FrozenSet, NamedTuple, Optional, Callable, Set, Tuple, Union
 
 import psutil
 
@@ -27,6 +27,16 @@ class LoggedInError(Exception):
 
 _log = logging.getLogger()
 
+# The configuration file only uses "[section]" headers and "key = value" lines.
+_SECTION_RE = re.compile(r"^\[([^\]]+)\]\s*$")
+_KV_RE = re.compile(r"^([^=;#\s][^=]*?)\s*=\s*(.*)$")
+
+# A command name and the rest of its line
+_CMD_RE = re.compile(r"\s*(\S+)(?:\s+(.*))?")
+
+# Key that marks the end of a command alias in the command prefix trie. No single character can collide with it.
+_TRIE_END = ""
+
 TypeUserAnywhere = Union[discord.Member, discord.User]
 
 TypeHandlerWithArgs = Callable[
@@ -34,9 +44,59 @@ TypeHandlerWithArgs = Callable[
 ]
 
 
+def read_config_sections(path: str) -> Dict[str, Dict[str, str]]:
+    """
+    Parse an ini-style configuration file into a dictionary of sections.
+
+    Like ConfigParser, keys are lowercased and lines starting with "#" or ";" are comments.
+
+    :param path: The path to the configuration file.
+    """
+    sections: Dict[str, Dict[str, str]] = {}
+    section: Optional[Dict[str, str]] = None
+    for line_no, line in enumerate(Path(path).read_text().splitlines(), start=1):
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        match = _SECTION_RE.match(line)
+        if match:
+            section = sections.setdefault(match.group(1), {})
+            continue
+        match = _KV_RE.match(line)
+        if not match:
+            raise ValueError(f"Unable to parse {path} line {line_no}: '{line}'")
+        if section is None:
+            raise ValueError(f"{path} line {line_no} is not in a section: '{line}'")
+        section[match.group(1).lower()] = match.group(2)
+    return sections
+
+
+class _SpamState:
+    """ The next time that a user can execute a command, and the amount of time to add to it if they try sooner """
+    __slots__ = ("expiry", "level")
+
+    def __init__(self, expiry: float, level: float) -> None:
+        self.expiry = expiry
+        self.level = level
+
+
+class ParsedConfig(NamedTuple):
+    """ A configuration file that has been read and checked, but not yet applied """
+    files: Dict[str, str]
+    commands: Dict[str, str]
+    helps: Dict[str, str]
+    priv_commands: Dict[str, str]
+    path: Path
+    prefix: str
+    token_path: str
+    admins: str
+
+
 class MarBot(discord.Client):
     # The magic string used to disable a command in the configuration file.
     CMD_DISABLED = "DISABLED"
+    # Split long messages into chunks of at most this many characters, leaving headroom under discord's 2000.
+    MAX_MESSAGE_LENGTH = 1900
 
     def __init__(
         self, config: Path = Path("config.ini"), **kwargs: discord.Intents
@@ -51,6 +111,7 @@ class MarBot(discord.Client):
         self.config = config
         self.voice_client: Optional[discord.VoiceClient] = None
         self.token = ""
+        self.token_path = ""
         # Map the actual command names to handlers
         self.HANDLERS: Dict[str, TypeHandlerWithArgs] = {
             "d20": self.handle_d20,
@@ -72,22 +133,36 @@ class MarBot(discord.Client):
         self.commands: Dict[
             str, TypeHandlerWithArgs
         ] = {}
+        # Prefix trie of command aliases: nested dicts keyed by character, with _TRIE_END mapping to the alias
+        self._cmd_trie: Dict[str, Any] = {}
+        # Map handlers to all of their command aliases, and the same for privileged commands
+        self._aliases_by_handler: Dict[TypeHandlerWithArgs, List[str]] = {}
+        self._priv_aliases_by_handler: Dict[TypeHandlerWithArgs, List[str]] = {}
         # Map the command names to help strings
         self.helps: Dict[str, str] = {}
+        # The response to a help command without arguments
+        self._help_all_msg = ""
         # Map the privileged command names in the .ini file's keys to handlers
         self.priv_commands = self.HANDLERS.copy()
-        # Map user names to the next time that they can execute a command
-        self.spam_protect: Dict[TypeUserAnywhere, float] = {}
-        # Map user names to the amount of time to add to their spam timer
-        self.spam_timers: Dict[TypeUserAnywhere, float] = {}
+        # Map user IDs to their spam protection state
+        self.spam: Dict[int, _SpamState] = {}
         # When a user is spam blocked, don't notify them that they can execute commands again more often than this
         self.SPAM_NOTIFICATION_THRESHOLD = 30
         # Only administrators can execute commands
         self.in_maintenance_mode = False
-        # List of administrator user names
-        self.admins: List[str] = []
-
-        self.reload_config(load_token=True)
+        # Set of administrator user names
+        self.admins: FrozenSet[str] = frozenset()
+        # Map sound keywords to the resolved path of their sound file
+        self._resolved_files: Dict[str, str] = {}
+        # Sound keywords whose sound file existed when it was last checked
+        self._valid_keys: Set[str] = set()
+        # The playlist as sent to chat, or None if self.files changed since it was built
+        self._playlist_rendered: Optional[str] = None
+        # (path, mtime_ns, size) of the last parsed configuration file, and its sections
+        self._cfg_cache: Optional[Tuple[Tuple[str, int, int], Dict[str, Dict[str, str]]]] = None
+
+        self.reload_config()
+        self.token = self._load_token(self.token_path)
         print("Added dynamic files:", self.add_all_dynamic_files())
 
         print("Initialized")
@@ -105,8 +180,11 @@ class MarBot(discord.Client):
 
     def add_a_sound(self, keyword: str, keyword_fname: str) -> Tuple[bool, str]:
         def is_in_add_path(fname: str) -> bool:
-            test_path = (self.add_path / fname).resolve()
-            return test_path.parent == self.add_path.resolve()
+            if os.sep in fname or (os.altsep and os.altsep in fname):
+                return False
+            # Catches "..", "." and drive-relative names.
+            normalized = os.path.normpath(os.path.join(self._add_path_str, fname))
+            return normalized.startswith(self._add_path_str)
         
         if not keyword.isalnum():
             return False, f"The file named for the command must be alphanumeric only, but it's '{keyword}'"
@@ -120,7 +198,7 @@ class MarBot(discord.Client):
         
         # Search the to_add subfolder for the mp3 to add and its accompanying text file that says what playlist name to use for it.
         try:
-            with open((self.add_path / keyword_fname).resolve(), "rt") as fh:
+            with open(self._add_path_resolved / keyword_fname, "rt") as fh:
                 mp3_fname = fh.readlines()[0].strip()
         except FileNotFoundError:
             return False, f"mp3 to add must be in the add subdir"
@@ -130,74 +208,127 @@ class MarBot(discord.Client):
         
         self.files[keyword] = mp3_fname
         try:
-            os.symlink((self.add_path / mp3_fname).resolve(), (self.sound_directory / mp3_fname).resolve())
+            os.symlink(self._add_path_resolved / mp3_fname, self._sound_dir_resolved / mp3_fname)
         except FileExistsError:
-            return True, f"that sound file already exists. I'm assigning {keyword} to it."
+            msg = f"that sound file already exists. I'm assigning {keyword} to it."
         else:
-            return True, f"sound added"
+            msg = f"sound added"
+        self._resolved_files[keyword] = (self._sound_dir_resolved / mp3_fname).as_posix()
+        self._valid_keys.add(keyword)
+        self.files_changed()
+        return True, msg
 
-    def reload_config(
-        self, config: Optional[str] = None, load_token: bool = False
-    ) -> None:
+    def files_changed(self) -> None:
         """
-        Reload the configuration file.
+        Forget anything built from self.files. Called whenever self.files is replaced or added to.
+        """
+        self._playlist_rendered = None
+
+    def reload_config(self, config: Optional[str] = None) -> None:
+        """
+        Reload the configuration file. The token is only loaded at startup.
 
         :param config: The name of the configuration file; use previously-loaded config if None.
-        :param load_token: If True, load the token from the config. Usually False when reloading while running.
         """
         _config: str = config or str(self.config)
+        self._apply_parsed(self._parse_and_validate(_config))
+        print(f"Loaded {_config}")
+
+    def _parse_and_validate(self, _config: str) -> ParsedConfig:
+        """
+        Read the configuration file and check it against the known commands, without changing the bot's state.
 
-        parser = configparser.ConfigParser()
-        parser.read(_config)
+        :param _config: The name of the configuration file.
+        """
+        # Skip re-parsing if the file hasn't changed since we last read it.
+        stat = os.stat(_config)
+        cache_key = (_config, stat.st_mtime_ns, stat.st_size)
+        if self._cfg_cache is not None and self._cfg_cache[0] == cache_key:
+            parser = self._cfg_cache[1]
+        else:
+            parser = read_config_sections(_config)
+            self._cfg_cache = (cache_key, parser)
 
         try:
-            new_files = dict(parser["files"])
-            new_commands = dict(parser["commands"])
-            new_helps = dict(parser["helps"])
-            new_priv_commands = dict(parser["priv_commands"])
-            new_path = Path(parser["config"]["path"])
-            new_add_path = new_path / "to_add"
-            new_prefix = parser["config"]["prefix"]
-            new_token = parser["config"]["token"]
-            new_admins = parser["admins"]["admins"]
+            # Copy the sections so that runtime changes (e.g. !add) don't leak into the cache.
+            parsed = ParsedConfig(
+                files=dict(parser["files"]),
+                commands=dict(parser["commands"]),
+                helps=dict(parser["helps"]),
+                priv_commands=dict(parser["priv_commands"]),
+                path=Path(parser["config"]["path"]),
+                prefix=parser["config"]["prefix"],
+                token_path=parser["config"]["token"],
+                admins=parser["admins"]["admins"],
+            )
         except KeyError as exc:
             raise KeyError(
                 f"Missing ini configuration section or configuration key '{exc.args[0]}'"
             )
+        new_commands, new_priv_commands = parsed.commands.keys(), parsed.priv_commands.keys()
+        configured = new_commands | new_priv_commands
 
-        for key in new_commands:
-            if key in new_priv_commands:
-                raise KeyError(
-                    f"Command key {key} is present in both commands and priv_commands"
-                )
+        collisions = new_commands & new_priv_commands
+        if collisions:
+            raise KeyError(
+                f"Command keys {sorted(collisions)} are present in both commands and priv_commands"
+            )
 
-        for key in self.HANDLERS.keys():
-            if key not in new_commands.keys() and key not in new_priv_commands.keys():
-                raise KeyError(
-                    f"Missing expected command key '{key}'. "
-                    f"If you meant to disable it, use '{key} = {MarBot.CMD_DISABLED}'"
-                )
+        missing = self.HANDLERS.keys() - configured
+        if missing:
+            raise KeyError(
+                f"Missing expected command keys {sorted(missing)}. "
+                f"If you meant to disable one, use e.g. '{min(missing)} = {MarBot.CMD_DISABLED}'"
+            )
 
-        for key in list(new_commands.keys()) + list(new_priv_commands.keys()):
-            if key not in self.HANDLERS.keys():
-                raise KeyError(
-                    f"Unexpected command key '{key}'. Remove it or check its spelling."
-                )
+        unexpected = configured - self.HANDLERS.keys()
+        if unexpected:
+            raise KeyError(
+                f"Unexpected command keys {sorted(unexpected)}. Remove them or check their spelling."
+            )
+
+        return parsed
+
+    def _apply_parsed(self, parsed: ParsedConfig) -> None:
+        """
+        Replace the bot's configuration with a validated one.
+
+        :param parsed: The configuration from _parse_and_validate.
+        """
+        new_commands, new_priv_commands = parsed.commands, parsed.priv_commands
 
         self.prefix, self.files, self.sound_directory, self.helps, self.add_path = (
-            new_prefix,
-            new_files,
-            new_path,
-            new_helps,
-            new_add_path,
+            parsed.prefix,
+            parsed.files,
+            parsed.path,
+            parsed.helps,
+            parsed.path / "to_add",
         )
-        self.admins = new_admins.split(",")
-        print(f"Admins: {', '.join(self.admins)}")
-        print("Files:", self.files)
-        if load_token:
-            with open(new_token, "r") as f:
-                self.token = f.read().strip()
-            print(f"New token from {new_token}")
+        self.token_path = parsed.token_path
+        self._prefix_len = len(self.prefix)
+        self.files_changed()
+        self._sound_dir_resolved = self.sound_directory.resolve()
+        try:
+            with os.scandir(self.sound_directory) as entries:
+                existing = {entry.name for entry in entries}
+        except OSError:
+            print(f"Unable to list sound directory {self.sound_directory}")
+            existing = set()
+        self._valid_keys = {
+            key
+            for key, value in self.files.items()
+            # Only stat the files that aren't directly in the sound directory.
+            if value in existing or (self.sound_directory / value).is_file()
+        }
+        self._add_path_resolved = self.add_path.resolve()
+        self._add_path_str = str(self._add_path_resolved) + os.sep
+        self._resolved_files = {
+            key: (self.sound_directory / value).resolve().as_posix()
+            for key, value in self.files.items()
+        }
+        self.admins = frozenset(admin.strip() for admin in parsed.admins.split(","))
+        print(f"Admins: {', '.join(sorted(self.admins))}")
+        _log.debug("Files: %s", self.files)
 
         self.priv_commands = {}
         self.commands = {}
@@ -230,20 +361,60 @@ class MarBot(discord.Client):
             elif cmd in new_commands:
                 manage_command(new_commands, self.commands, cmd, handler)
 
-        if self.handle_restart not in list(self.priv_commands.values()) + list(
-            self.commands.values()
+        if (
+            self.handle_restart not in self.priv_commands.values()
+            and self.handle_restart not in self.commands.values()
         ):
             print("Re-adding restart command to privileged commands to avoid lockout")
             self.priv_commands["restart"] = self.handle_restart
 
-        print("Privileged command mapping")
-        pprint.pprint(
-            {key: value.__name__ for key, value in self.priv_commands.items()}
-        )
-        print("Command mapping")
-        pprint.pprint({key: value.__name__ for key, value in self.commands.items()})
+        self._cmd_trie = {}
+        for alias in self.commands:
+            node = self._cmd_trie
+            for char in alias:
+                node = node.setdefault(char, {})
+            node[_TRIE_END] = alias
+
+        self._aliases_by_handler = {}
+        for alias, handler in self.commands.items():
+            self._aliases_by_handler.setdefault(handler, []).append(alias)
+        self._priv_aliases_by_handler = {}
+        for alias, handler in self.priv_commands.items():
+            self._priv_aliases_by_handler.setdefault(handler, []).append(alias)
+
+        msg = f"All commands must be prefixed with {self.prefix}.\nCommands: {', '.join(self.prefix + cmd for cmd in self.commands)}.\n"
+        msg += f"Admin commands: {', '.join(self.prefix + cmd for cmd in self.priv_commands)}"
+        if self.helps.get("help"):
+            # A bad template must not abort a half-applied config, so fall back to the bare command list.
+            try:
+                msg += "\n" + self.helps["help"].format(
+                    cmd=f"{self.prefix}help"
+                )  # only add a new line if help command help is present
+            except (KeyError, IndexError, ValueError, AttributeError) as exc:
+                _log.warning("Can't format the help command's help string, leaving it out: %r", exc)
+        self._help_all_msg = msg
+
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug(
+                "Privileged command mapping\n%s",
+                pprint.pformat({key: value.__name__ for key, value in self.priv_commands.items()}),
+            )
+            _log.debug(
+                "Command mapping\n%s",
+                pprint.pformat({key: value.__name__ for key, value in self.commands.items()}),
+            )
 
-        print(f"Loaded {_config}")
+    @staticmethod
+    def _load_token(path: str) -> str:
+        """
+        Read the bot's login token.
+
+        :param path: The path to the text file containing the token.
+        """
+        with open(path, "r") as f:
+            token = f.read().strip()
+        print(f"New token from {path}")
+        return token
 
     def run(self, *args: Any, **kwargs: Any) -> None:
         """
@@ -254,25 +425,35 @@ class MarBot(discord.Client):
     def are_equivalent_commands(self, candidates: List[str]) -> bool:
         if not candidates:
             return False
-        return all(
-            self.commands.get(x) == self.commands.get(candidates[0]) for x in candidates
-        )
+        return len({self.commands.get(x) for x in candidates}) == 1
+
+    def get_command_prefixes_of(self, text: str) -> List[str]:
+        """
+        Find every command alias that the given text starts with, shortest first.
+
+        :param text: The text to match against, without the command prefix.
+        """
+        matches = []
+        node = self._cmd_trie
+        for char in text:
+            if char not in node:
+                break
+            node = node[char]
+            if _TRIE_END in node:
+                matches.append(node[_TRIE_END])
+        return matches
 
     def get_all_aliases_for(self, command: str, include_priv: bool) -> List[str]:
         if not command:
             return []
 
-        candidates = [
-            x
-            for x in self.commands
-            if self.commands.get(x) == self.commands.get(command)
-        ]
+        handler = self.commands.get(command)
+        # Copy, so that callers can't change the index.
+        candidates = list(self._aliases_by_handler[handler]) if handler else []
         if include_priv:
-            candidates += [
-                x
-                for x in self.priv_commands
-                if self.priv_commands.get(x) == self.priv_commands.get(command)
-            ]
+            priv_handler = self.priv_commands.get(command)
+            if priv_handler:
+                candidates = candidates + self._priv_aliases_by_handler[priv_handler]
         return candidates
 
     async def handle_reload_config(
@@ -310,10 +491,10 @@ class MarBot(discord.Client):
         self, user: TypeUserAnywhere, channel: discord.TextChannel, args: List[str]
     ) -> None:
         printable = pprint.pformat(
-            {str(k): str(v) for k, v in self.spam_protect.items()}
+            {str(k): str(v.expiry) for k, v in self.spam.items()}
         )
         await channel.send(
-            f"Current time: {int(time.time())} Current spam protection status:\n{printable}"
+            f"Current time: {int(time.monotonic())} Current spam protection status:\n{printable}"
         )
 
     async def handle_help(
@@ -334,16 +515,11 @@ class MarBot(discord.Client):
         keyword = next(iter(args), None)
 
         if not keyword:
-            msg = f"All commands must be prefixed with {self.prefix}.\nCommands: {', '.join(self.prefix + cmd for cmd in self.commands)}.\n"
-            msg += f"Admin commands: {', '.join(self.prefix + cmd for cmd in self.priv_commands)}"
-            if self.helps.get("help"):
-                msg += "\n" + self.helps["help"].format(
-                    cmd=f"{self.prefix}help"
-                )  # only add a new line if help command help is present
-            await channel.send(msg)
+            await channel.send(self._help_all_msg)
             return
 
-        if not self.is_user_admin(user):
+        is_admin = self.is_user_admin(str(user))
+        if not is_admin:
             if keyword not in self.commands:
                 await channel.send(f"No such user command {keyword}")
                 return
@@ -352,17 +528,12 @@ class MarBot(discord.Client):
                 await channel.send(f"No such user or admin command {keyword}")
                 return
 
-        aliases = self.get_all_aliases_for(keyword, self.is_user_admin(user))
+        aliases = self.get_all_aliases_for(keyword, is_admin)
         for alias in aliases:
             if alias in self.helps:
                 await channel.send(
                     self.helps[alias].format(
-                        cmd=", ".join(
-                            [
-                                self.prefix + alias
-                                for alias in aliases
-                            ]
-                        )
+                        cmd=", ".join(self.prefix + each for each in aliases)
                     )
                 )
                 return
@@ -387,31 +558,33 @@ class MarBot(discord.Client):
             await channel.send(f"{user.mention}, you must be in a voice channel")
             return
 
-        for member in self.get_all_members():
-            permissions = user.voice.channel.permissions_for(member)
-            print(
-                f"{member} - Join request for {user.voice.channel} - Connect: {permissions.connect} - Speak: {permissions.speak}"
-            )
-            if permissions.connect and permissions.speak:
-                break
-        else:
+        me = user.voice.channel.guild.me
+        permissions = user.voice.channel.permissions_for(me)
+        _log.debug(
+            "%s - Join request for %s - Connect: %s - Speak: %s",
+            me, user.voice.channel, permissions.connect, permissions.speak,
+        )
+        if not (permissions.connect and permissions.speak):
             await channel.send(
                 f"{user.mention}, I am missing connect or speak permission for your channel"
             )
             return
 
+        # user.voice becomes None if they leave voice while we wait below, so hold on to the channel.
+        target = user.voice.channel
         if not self.voice_client:
-            self.voice_client = cast(discord.VoiceClient, await user.voice.channel.connect())
+            self.voice_client = cast(discord.VoiceClient, await target.connect())
 
-        await self.voice_client.move_to(user.voice.channel)
+        await self.voice_client.move_to(target)
 
-        timeout = time.time() + 10
-        while self.voice_client.channel != user.voice.channel or not self.voice_client.is_connected():
-            time.sleep(0.1)
-            if time.time() >= timeout:
-                print("Timed out")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 10
+        while self.voice_client.channel != target or not self.voice_client.is_connected():
+            await asyncio.sleep(0.1)
+            if loop.time() >= deadline:
+                _log.info("Timed out joining %s", target)
                 return
-        print("Connected")
+        _log.info("Connected to %s", target)
         return
 
     async def handle_leave_voice(
@@ -481,7 +654,7 @@ class MarBot(discord.Client):
     async def play_iface(self, user: TypeUserAnywhere, channel: Optional[discord.TextChannel], args: List[str]) -> None:
 
         if not self.voice_client:
-            print("No voice client")
+            _log.debug("No voice client")
             if channel:
                 # Try to join the user automatically
                 if not await self.handle_join_user(user, channel, []) or not self.voice_client:
@@ -509,13 +682,16 @@ class MarBot(discord.Client):
             return
 
         try:
-            play_file = self.sound_directory / self.files[keyword]
+            play_path = self._resolved_files[keyword]
         except KeyError:
             await self.optional_send(channel, f"{user.mention} No file for {keyword}")
             return
+        if keyword not in self._valid_keys:
+            await self.optional_send(channel, f"{user.mention} The sound file for {keyword} is missing")
+            return
 
-        print(f"Play '{keyword}' ==> {play_file}")
-        play_me = discord.FFmpegPCMAudio(play_file.resolve().as_posix())
+        _log.debug("Play '%s' ==> %s", keyword, play_path)
+        play_me = discord.FFmpegPCMAudio(play_path)
 
         if self.voice_client.is_playing():
             return
@@ -549,18 +725,24 @@ class MarBot(discord.Client):
         await channel.send(
             f"{user.mention} Here are the files for {self.prefix}{play_cmd}:"
         )
-        printable = ""
-        for key, value in self.files.items():
-            printable += f"{key}: {value.replace('.mp3', '')}\n"
- 
-        if len(printable) > 2000:
-            sendable = ""
+        if self._playlist_rendered is None:
+            self._playlist_rendered = "".join(
+                f"{key}: {value.replace('.mp3', '')}\n" for key, value in self.files.items()
+            )
+        printable = self._playlist_rendered
+
+        if len(printable) > MarBot.MAX_MESSAGE_LENGTH:
+            buf: List[str] = []
+            size = 0
             for line in printable.splitlines():
-                if len(sendable + line) > 2000:
-                    await channel.send(f"{sendable}")
-                    sendable = ""
-                sendable += line + "\n"
-            await channel.send(sendable)
+                line_size = len(line) + 1
+                if buf and size + line_size > MarBot.MAX_MESSAGE_LENGTH:
+                    await channel.send("\n".join(buf))
+                    buf.clear()
+                    size = 0
+                buf.append(line)
+                size += line_size
+            await channel.send("\n".join(buf))
             return
 
         try:
@@ -621,7 +803,7 @@ class MarBot(discord.Client):
         self, user: TypeUserAnywhere, channel: discord.TextChannel, unused_args: List[str]
     ) -> None:
         """Dump the admin list"""
-        await channel.send(f"{', '.join(self.admins)}")
+        await channel.send(f"{', '.join(sorted(self.admins))}")
 
     async def handle_stop(
         self, user: TypeUserAnywhere, channel: discord.TextChannel, unused_args: List[str]
@@ -667,39 +849,39 @@ class MarBot(discord.Client):
                 await self.optional_send(channel, f"{user.mention} {msg}")
 
 
-    def is_user_admin(self, user: Union[discord.User, discord.Member]) -> bool:
+    def is_user_admin(self, user_str: str) -> bool:
         """
         Determine if the given user can access privileged commands.
 
-        :param user: The user to verify.
-        :param channel: The channel to respond to (usually the one it was sent on).
+        :param user_str: The user name to verify, i.e. str() of the user.
         """
-        if str(user) not in self.admins:
-            return False
-        return True
+        return user_str in self.admins
 
     @staticmethod
     def is_channel_authorized(channel: discord.abc.Messageable) -> bool:
         return "bot" in str(channel)
 
-    def is_user_spam_blocked(self, user: TypeUserAnywhere) -> bool:
-        try:
+    def is_user_spam_blocked(self, user_id: int) -> bool:
+        now = time.monotonic()
+        state = self.spam.get(user_id)
+        if state is not None:
             # The user executed commands too fast. Increase the time until they can try again.
-            if self.spam_protect[user] > time.time():
-                self.spam_timers[user] = 1 + self.spam_timers[user] * 2
-                self.spam_protect[user] += self.spam_timers[user]
+            if state.expiry > now:
+                state.level = 1 + state.level * 2
+                state.expiry += state.level
                 return True
-            if self.spam_protect[user] == -1:
+            if state.expiry == -1:
                 return True
-        except KeyError:
-            pass
 
         # The user is no longer under spam block or was never spam blocked.
         # Set the time until that user can execute another command to the default.
         # An improvement would be "x commands over y time" instead of "1 command per y time"
         to_add = 3
-        self.spam_protect[user] = time.time() + to_add
-        self.spam_timers[user] = to_add
+        if state is None:
+            self.spam[user_id] = _SpamState(now + to_add, to_add)
+        else:
+            state.expiry = now + to_add
+            state.level = to_add
         return False
 
     async def on_ready(self) -> None:
@@ -721,32 +903,31 @@ class MarBot(discord.Client):
         if message.author == self.user:
             return
 
+        content = message.content
+        # Ignore everything that isn't a command before doing any other work.
+        if len(content) <= self._prefix_len or not content.startswith(self.prefix):
+            return
+
         channel = message.channel
         author = message.author
-        content = message.content
-        command = None
+        # Stringifying a user is relatively expensive, so do it once.
+        author_str = str(author)
+        author_id = author.id
 
         if not isinstance(channel, discord.TextChannel):
             await author.send(f"{author.mention}, I can't receive commands in {channel} because it's not a text channel")
             return
 
-        if content.startswith(self.prefix):
-            command = content[len(self.prefix) :]
-
-        if not command:
+        # Avoid log spam by only getting the first line of the first hundred characters
+        unsplit_command = content[self._prefix_len : self._prefix_len + 100].lower().partition("\n")[0]
+        match = _CMD_RE.match(unsplit_command)
+        if not match:
             return
-
-        # Avoid log spam by only getting the first line
-        command = command.lower().splitlines()[0]
-        # Avoid log spam by only getting the first hundred characters
-        command = command[:100]
-
-        unsplit_command = command
-        args = command.split()[1:]
-        command = command.split()[0]
-        log_content = "\\n".join(content.splitlines())
-
-        print(f"{author}@{channel}: {log_content} ==> {command}")
+        command = match.group(1)
+        args = (match.group(2) or "").split()
+        if _log.isEnabledFor(logging.INFO):
+            log_content = "\\n".join(content.splitlines())
+            _log.info("%s@%s: %s ==> %s", author_str, channel, log_content, command)
 
         if not self.is_channel_authorized(channel):
             await author.send(
@@ -754,41 +935,38 @@ class MarBot(discord.Client):
             )
             return
 
+        is_admin = self.is_user_admin(author_str)
+
         try:
             if command in self.priv_commands:
-                if self.is_user_admin(author):
+                if is_admin:
                     function = self.priv_commands[command]
                     # Do the function now to prevent accidental lockout.
-                    print("\tPrivileged command, running immediately")
+                    _log.debug("\tPrivileged command, running immediately")
                     await function(author, channel, args)
                     return
                 else:
                     raise PermissionError("No permission")
             else:
                 # If we can't get an exact match, try space-less matching instead, to support commands like "!!<sound name>"
-                print("Trying startswith for", command)
+                _log.debug("Trying startswith for %s", command)
                 try:
                     function = self.commands[command]
                 except KeyError as exc:
-                    candidates = []
-                    for candidate in self.commands:
-                        #print(candidate, "vs", unsplit_command)
-                        if unsplit_command.startswith(candidate):
-                            candidates.append(candidate)
+                    candidates = self.get_command_prefixes_of(unsplit_command)
 
                     if len(candidates) > 1:
                         if not self.are_equivalent_commands(candidates):
                             raise TooManyMatches(candidates) from exc
                     elif len(candidates) == 0:
                         raise KeyError("No candidates") from exc
-                    candidate = candidates[0]
+                    # Prefer the longest alias so that e.g. "playair" splits into "play" and "air", not "p" and "layair"
+                    candidate = candidates[-1]
 
-                    print(
-                        f"Splitting {unsplit_command} at {candidate}: {unsplit_command.split(candidate)}"
-                    )
-                    args = unsplit_command.split(candidate)[1:]
+                    _log.debug("Splitting %s at %s", unsplit_command, candidate)
+                    args = unsplit_command[len(candidate) :].split()
                     command = candidate
-                    print(f"{command}: {args}")
+                    _log.debug("%s: %s", command, args)
                     function = self.commands[command]
 
         except TooManyMatches as exc:
@@ -800,25 +978,26 @@ class MarBot(discord.Client):
             await channel.send(f"{author.mention}, no such command '{command}'")
             return
 
-        print("\tGot", function.__name__)
-        if self.is_user_admin(author):
+        _log.debug("\tGot %s", function.__name__)
+        if is_admin:
             # Use maintenance mode to simulate regular user permissions
             if not self.in_maintenance_mode:
-                print("\tAllow: user is admin")
+                _log.debug("\tAllow: user is admin")
                 await function(author, channel, args)
                 return
-        if not self.is_user_admin(author) and self.in_maintenance_mode:
-            print("\tDisallow: In maintenance mode and user is not admin")
+        if not is_admin and self.in_maintenance_mode:
+            _log.debug("\tDisallow: In maintenance mode and user is not admin")
             return
-        if self.is_user_spam_blocked(author):
-            print("\tDisallow: User is spam blocked")
-            print(f"{author} is spam blocked")
-            if self.spam_timers[author] <= self.SPAM_NOTIFICATION_THRESHOLD:
+        if self.is_user_spam_blocked(author_id):
+            _log.debug("\tDisallow: User is spam blocked")
+            _log.info("%s is spam blocked", author_str)
+            state = self.spam[author_id]
+            if state.level <= self.SPAM_NOTIFICATION_THRESHOLD:
                 await author.send(
-                    f"Spam protection - I can't respond to your messages for approximately {int(self.spam_protect[author] - time.time())} seconds"
+                    f"Spam protection - I can't respond to your messages for approximately {int(state.expiry - time.monotonic())} seconds"
                 )
             return
-        print("\tAllow: Default reason")
+        _log.debug("\tAllow: Default reason")
         await function(author, channel, args)
 
 def create() -> MarBot:
@@ -827,11 +1006,12 @@ def create() -> MarBot:
     """
 
     # Since we can't use run and await self.close() successfully, we have to set up logging ourselves.
+    # Log to the root logger at INFO so that the bot's own command log shows up alongside discord's.
     discord.utils.setup_logging(
         handler=discord.utils.MISSING,
         formatter=discord.utils.MISSING,
         level=discord.utils.MISSING,
-        root=False,
+        root=True,
     )
 
     intents = discord.Intents.default()
@@ -848,7 +1028,6 @@ def main(client: Optional[MarBot] = None, loop = None) -> None:
     async def main_task() -> None:
         await client.start(client.token)
 
-    debug = False
     loop_owner = False
     # Work around `await self.close()` crashing somewhere without giving a traceback.
     if loop is None:
@@ -856,13 +1035,11 @@ def main(client: Optional[MarBot] = None, loop = None) -> None:
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         loop = asyncio.get_event_loop()
-    futures = [asyncio.ensure_future(main_task())]
     try:
-        loop.run_until_complete(asyncio.gather(*futures, return_exceptions=debug))
+        loop.run_until_complete(main_task())
         print("Try done")
     except:
-        future_logout = [asyncio.ensure_future(client.close())]
-        loop.run_until_complete(asyncio.gather(*future_logout, return_exceptions=debug))
+        loop.run_until_complete(client.close())
         print("Closing")
     finally:
         if loop_owner:
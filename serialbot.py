@@ -1,11 +1,12 @@
-import concurrent.futures
+import collections
 import logging
+import os
 import threading
 import asyncio
 import sys
 import time
 from types import TracebackType
-from typing import Any, List, Optional
+from typing import Any, Callable, Deque, List, Optional
 
 import discord
 import discord.types
@@ -27,9 +28,40 @@ class SerialChannel(discord.TextChannel):
 
 
 class SerialMember(discord.Member):
+    __slots__ = ("discord_member",)
+
     def __init__(self, discord_member: discord.Member) -> None:
         self.discord_member = discord_member
 
+    # Forward the attributes that get read on every play directly, rather than through __getattr__.
+    @property
+    def id(self) -> int:  # type: ignore # Read-only is fine, we only forward.
+        return self.discord_member.id
+
+    @property
+    def name(self) -> str:  # type: ignore # Read-only is fine, we only forward.
+        return self.discord_member.name
+
+    @property
+    def guild(self) -> discord.Guild:  # type: ignore # Read-only is fine, we only forward.
+        return self.discord_member.guild
+
+    @property
+    def voice(self) -> Optional[discord.VoiceState]:
+        return self.discord_member.voice
+
+    @property
+    def display_name(self) -> str:
+        return self.discord_member.display_name
+
+    @property
+    def roles(self) -> List[discord.Role]:
+        return self.discord_member.roles
+
+    @property
+    def bot(self) -> bool:  # type: ignore # Read-only is fine, we only forward.
+        return self.discord_member.bot
+
     @property
     def mention(self) -> str:
         return f"<@display={self.display_name} user={self.name} id={self.id}>"
@@ -53,44 +85,95 @@ class SerialBot(discordbot.MarBot):
 
         # TODO: Handle hardware_user config instead of hardcoding it into serial_user.
         self.serial_user = "marauderiic"
-        self.results: List[concurrent.futures.Future] = []  # type: ignore # There's only so much I can care about getting this typed
-
-        self.thread_done = (
-            False  # Setting this flag to True tells thread_serial to stop.
-        )
+        # The serial user's member object while they're in a voice channel, kept up to date by on_voice_state_update.
+        self._serial_user_ref: Optional[discord.Member] = None
+        # Reused for every serial command instead of being created per press.
+        self._serial_channel = SerialChannel()
+        self._serial_member: Optional[SerialMember] = None
+        # The sound count line and sound list to send to the soundboard, or None if self.files changed since
+        self._serial_handshake_cache: Optional[bytes] = None
+        # Outstanding serial commands, oldest first, so that old ones can be cancelled. Also keeps the tasks alive.
+        self.results: Deque[asyncio.Task[None]] = collections.deque()
+        # Only one serial command at a time should try to join voice.
+        self._serial_join_lock = asyncio.Lock()
+        # The voice join started for a serial command, which may outlive the command that started it.
+        self._serial_join_task: Optional[asyncio.Task[None]] = None
+
+        # Setting this event tells thread_serial or serial_reader to stop.
+        self.thread_done = threading.Event()
+        # Set once discord reports that the bot is ready, so that thread_serial can start.
+        self.ready_event = threading.Event()
+        # Where the serial port is polled from a thread (Windows), this is that thread.
         self.thread = threading.Thread(target=thread_serial, args=[self, port, baud])
+        # Elsewhere, the serial port is read from the event loop by this task.
+        self.port, self.baud = port, baud
+        self._serial_task: Optional[asyncio.Task[None]] = None
+
+    def files_changed(self) -> None:
+        super().files_changed()
+        self._serial_handshake_cache = None
+
+    def serial_handshake(self) -> bytes:
+        """
+        Get the sound count line followed by the sound list, to send to the soundboard when it asks for them.
+        """
+        if self._serial_handshake_cache is None:
+            names = list(self.files)
+            header = f"{len(names)}\n"
+            body = "\n".join(names) + "\n"
+            self._serial_handshake_cache = (header + body).encode(encoding="ascii")
+        return self._serial_handshake_cache
 
     def thread_handle_serial_message(
         self, serial_data: str, loop: asyncio.AbstractEventLoop
     ) -> None:
         """
-        Handle a serial command. Right now this means join the soundboard user's voice channel and play a sound.
+        Hand a serial command from the serial thread over to the event loop.
 
         :param serial_data: Raw serial string that represents a complete command
         :param loop: The asyncio loop used to submit commands to the main MarBot task.
         """
+        if loop is None:
+            raise ValueError("No asyncio event loop")
+
+        # Nothing here waits for the result, so skip the concurrent.futures.Future that run_coroutine_threadsafe makes.
+        loop.call_soon_threadsafe(self.dispatch_serial_message, serial_data)
+
+    def dispatch_serial_message(self, serial_data: str) -> None:
+        """
+        Start handling a serial command. Must be called from the event loop.
+
+        :param serial_data: Raw serial string that represents a complete command
+        """
+        self.results.append(asyncio.create_task(self.handle_serial_message(serial_data)))
+        # Prune outdated coroutines and their results, keeping the newest 5 - an arbitrary number
+        while len(self.results) > 5:
+            self.results.popleft().cancel()
+
+    async def handle_serial_message(self, serial_data: str) -> None:
+        """
+        Handle a serial command. Right now this means join the soundboard user's voice channel and play a sound.
+
+        :param serial_data: Raw serial string that represents a complete command
+        """
         if not self.is_ready():
             _log.warning(
                 f"Discord not connected; not ready to handle serial data: '{serial_data}'"
             )
             return
 
-        if loop is None:
-            raise ValueError("No asyncio event loop")
-        
-        if serial_data == "QUIT_NOW":
-            return
-
-        user = None
-        for guild in self.guilds:
-            for member in guild.members:
-                if (
-                    member.name == self.serial_user
-                    and member.voice
-                    and member.voice.channel
-                ):
-                    user = member
-                    break
+        user = self._serial_user_ref
+        if user is None:
+            for guild in self.guilds:
+                for member in guild.members:
+                    if (
+                        member.name == self.serial_user
+                        and member.voice
+                        and member.voice.channel
+                    ):
+                        user = member
+                        break
+            self._serial_user_ref = user
 
         if user is None or user.voice is None or user.voice.channel is None:
             _log.warning(
@@ -98,50 +181,113 @@ class SerialBot(discordbot.MarBot):
             )
             return
 
-        if not self.voice_client or (
-            self.voice_client and self.voice_client.channel != user.voice.channel
-        ):
-            self.results.append(
-                asyncio.run_coroutine_threadsafe(
-                    self.handle_join_user(user, SerialChannel(), []), loop
-                )
-            )
-            # TODO: Surely there's a callback for this.
-            timeout = time.time() + 5
-            while time.time() < timeout:
-                if (
-                    self.voice_client
-                    and self.voice_client.is_connected()
-                    and self.voice_client.channel == user.voice.channel
-                ):
-                    break
-                time.sleep(0.1)
-            else:
-                _log.warning(
-                    "Voice connection did not complete in timeout, try again when the bot joins"
-                )
-                return
+        async with self._serial_join_lock:
+            voice_client = self.voice_client
+            if voice_client is None or voice_client.channel != user.voice.channel:
+                # handle_join_user returns once the voice connection is complete (or has failed).
+                # Shield it so that a slow connection still completes, and wait on that same join from the next press
+                # instead of starting a second connect().
+                join = self._serial_join_task
+                if join is None or join.done():
+                    join = asyncio.create_task(self.handle_join_user(user, self._serial_channel, []))
+                    join.add_done_callback(self._serial_join_done)
+                    self._serial_join_task = join
+                try:
+                    await asyncio.wait_for(asyncio.shield(join), timeout=5)
+                except asyncio.TimeoutError:
+                    _log.warning(
+                        "Voice connection did not complete in timeout, try again when the bot joins"
+                    )
+                    return
+                except Exception:
+                    pass  # Logged by _serial_join_done; the connection check below reports the failure.
+                if not self.voice_client or not self.voice_client.is_connected():
+                    _log.warning("Unable to join the serial user's voice channel")
+                    return
 
         serial_data = serial_data.strip()
 
-        self.results.append(
-            asyncio.run_coroutine_threadsafe(
-                self.handle_play(SerialMember(user), SerialChannel(), [serial_data]),
-                loop,
-            )
-        )
+        if self._serial_member is None or self._serial_member.discord_member is not user:
+            self._serial_member = SerialMember(user)
+        await self.handle_play(self._serial_member, self._serial_channel, [serial_data])
 
-        # Prune outdated coroutines and their results.
-        if len(self.results) > 5:
-            for result in self.results[:5]:  # Cancel the first 5 - an arbitrary number
-                result.cancel()
-            # Continue waiting for everything else
-            self.results = self.results[5:]
+    @staticmethod
+    def _serial_join_done(join: asyncio.Task[None]) -> None:
+        """
+        Retrieve and log the result of a serial voice join, which nothing else may be waiting on.
+
+        :param join: The finished join task.
+        """
+        if not join.cancelled() and join.exception() is not None:
+            _log.error("Joining the serial user's voice channel failed", exc_info=join.exception())
+
+    async def serial_reader(self) -> None:
+        """
+        Read the serial port with loop.add_reader instead of a thread, reconnecting as needed. POSIX only.
+        """
+        _log.info("Serial waiting for discord bot to come online")
+        await self.wait_until_ready()
+
+        loop = asyncio.get_running_loop()
+        protocol = SoundboardProtocol(self, self.dispatch_serial_message)
+        warned = False  # Don't warn consecutively about reconnecting.
+        while not self.thread_done.is_set():
+            try:
+                if not warned:
+                    _log.info("Connecting to serial %s...", self.port)
+                with serial.Serial(port=self.port, baudrate=self.baud, timeout=0) as iface:
+                    iface.reset_input_buffer()  # Clear boot info
+                    protocol.reset()
+                    warned = False
+                    # Resolved when we should stop reading this port.
+                    done: asyncio.Future[None] = loop.create_future()
+
+                    def on_readable() -> None:
+                        try:
+                            # Readable with nothing waiting means that the device went away, which read() reports.
+                            protocol.feed(iface, iface.read(iface.in_waiting or 1))
+                        except (serial.serialutil.SerialException, OSError) as exc:  # in_waiting raises a bare OSError
+                            if not done.done():
+                                done.set_exception(exc)
+                        if self.thread_done.is_set() and not done.done():
+                            done.set_result(None)
+
+                    loop.add_reader(iface.fileno(), on_readable)
+                    try:
+                        await done
+                    finally:
+                        loop.remove_reader(iface.fileno())
+
+            except (serial.serialutil.SerialException, OSError):
+                if not warned:
+                    _log.warning("Can't talk to serial device. Retrying...")
+                    warned = True
+                await asyncio.sleep(5)
+
+    async def on_ready(self) -> None:
+        await super().on_ready()
+        self.ready_event.set()
+
+    async def on_voice_state_update(
+        self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState
+    ) -> None:
+        """
+        Track the serial user's member object as they join and leave voice channels.
+        """
+        if member.name == self.serial_user and after.channel:
+            self._serial_user_ref = member
+        elif self._serial_user_ref is not None and member.id == self._serial_user_ref.id and after.channel is None:
+            self._serial_user_ref = None
 
     async def setup_hook(self) -> None:
         await super().setup_hook()
-        _log.debug("Starting serial thread")
-        self.thread.start()
+        if sys.platform == "win32":
+            # Serial ports can't be waited on by the event loop on Windows.
+            _log.debug("Starting serial thread")
+            self.thread.start()
+        else:
+            _log.debug("Starting serial reader")
+            self._serial_task = asyncio.create_task(self.serial_reader())
 
     def __enter__(self) -> "SerialBot":
         self.serial_bot_start()
@@ -159,12 +305,92 @@ class SerialBot(discordbot.MarBot):
         discordbot.main(self, loop)
 
     def serial_bot_stop(self) -> None:
-        self.thread_done = True
-        self.thread.join()
+        self.thread_done.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self._serial_task is not None:
+            self._serial_task.cancel()
+            try:
+                loop.run_until_complete(self._serial_task)
+            except asyncio.CancelledError:
+                pass
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
 
 
+class SoundboardProtocol:
+    """
+    Split the soundboard's serial output into lines, answer its requests, and pass sound commands on.
+    """
+
+    def __init__(self, client: SerialBot, dispatch: Callable[[str], None]) -> None:
+        """
+        :param client: The bot whose sounds the soundboard plays.
+        :param dispatch: Called with every line that is a sound command rather than a status message.
+        """
+        self.client = client
+        self.dispatch = dispatch
+        self.buffer = bytearray()
+        self.last_upload_at = 0.0
+        self.state = 0
+
+    def reset(self) -> None:
+        """
+        Forget any partial line, e.g. after (re)connecting.
+        """
+        self.buffer.clear()
+
+    def feed(self, iface: serial.Serial, chunk: bytes) -> None:
+        """
+        Handle newly received serial data.
+
+        :param iface: The serial port that the data came from, used to answer the soundboard.
+        :param chunk: The received bytes.
+        """
+        self.buffer += chunk
+
+        # No matter what state we're in, handle and discard every complete line.
+        while (newline := self.buffer.find(b"\n")) != -1:
+            data = self.buffer[:newline].decode("ascii", errors="replace").strip()
+            del self.buffer[: newline + 1]
+            if not data:
+                continue
+
+            if data.startswith("~WARNING"):
+                _log.warning("Serial rx: %s", data)
+            elif data.startswith("~ERROR"):
+                _log.error("Serial rx: %s", data)
+            else:
+                _log.debug("state %d, serial rx: '%s'", self.state, data)
+
+            if data == "~Waiting for sounds":
+                if time.time() - self.last_upload_at < 5:
+                    _log.error("Sound board boot loop detected, bailing!")
+                    self.client.thread_done.set()
+                    return
+
+                # One write so that the soundboard gets the count and the list together.
+                handshake = self.client.serial_handshake()
+                iface.write(handshake)
+                _log.debug("Sent %s", handshake)
+                _log.info("Serial ready!")
+                self.last_upload_at = time.time()
+                iface.reset_input_buffer()  # Maybe we got boot info again
+                self.reset()
+                self.state = 1
+            elif data == "~Soundboard ready":
+                if self.state == 0:
+                    _log.info("Soundboard is already ready! Be sure to restart it if your local sound files have changed.")
+                self.state = 2
+
+            if not data.startswith("~"):
+                # Drop lines that can't be played here, before they cost a task or a cross-thread wakeup.
+                if data not in self.client.files:
+                    _log.debug("unknown sound %r", data)
+                    continue
+                self.dispatch(data)
+
+
 def thread_serial(client: SerialBot, port: str, baud: int = 115200) -> None:
     """
     Poll for lines in the serial data
@@ -173,81 +399,48 @@ def thread_serial(client: SerialBot, port: str, baud: int = 115200) -> None:
 
     #_log.setLevel(logging.DEBUG)
     _log.info("Serial waiting for discord bot to come online")
-    # TODO: Use on_ready instead.
-    while not client.thread_done and not client.is_ready():
-        time.sleep(0.1)
+    while not client.thread_done.is_set():
+        if client.ready_event.wait(timeout=0.5):
+            break
 
+    protocol = SoundboardProtocol(client, lambda data: client.thread_handle_serial_message(data, loop))
     warned = False  # Don't warn consecutively about reconnecting.
-    last_upload_at = 0
-    state = 0
-    while not client.thread_done:
+    while not client.thread_done.is_set():
         try:
             if not warned:
                 _log.info("Connecting to serial %s...", port)
             with serial.Serial(port=port, baudrate=baud, timeout=1) as iface:
                 iface.reset_input_buffer()  # Clear boot info
-                data = ""
+                protocol.reset()
                 warned = False
-                while not client.thread_done:
+                while not client.thread_done.is_set():
                     # TODO: Handle serial.serialutil.SerialException here for when the soundboard is unplugged and plugged back in
-                    rx_data = iface.readline().decode(errors="replace")
-                    data += rx_data
+                    # Block for at most the read timeout until something arrives, then take the rest of the burst too.
+                    chunk = iface.read(iface.in_waiting or 1)
+                    if chunk and iface.in_waiting:
+                        chunk += iface.read(iface.in_waiting)
 
                     # Handle any flag changes that happened while we were reading data
-                    if client.thread_done:
-                        break  # type: ignore # This is reachable because thread_done is volatile
-
-                    if not data:
-                        continue
-
-                    if data.startswith("~WARNING"):
-                        _log.warning("Serial rx: %s", data.strip())
-                    elif data.startswith("~ERROR"):
-                        _log.error("Serial rx: %s", data.strip())
-                    else:
-                        _log.debug("state %d, serial rx: '%s'", state, data)
-
-                    if "\n" in data:  # No matter what state we're in, clear the data if we got a full line.
-                        data = data.strip()
-                        if data == "~Waiting for sounds":
-                            if time.time() - last_upload_at < 5:
-                                _log.error("Sound board boot loop detected, bailing!")
-                                client.thread_done = True
-                                break
-
-                            serial_sounds = "\n".join(x for x in client.files.keys()).encode(encoding="ascii") + b"\n"
-                            iface.write((str(len(client.files.keys())) + "\n").encode(encoding="ascii"))
-                            _log.debug("Sent %s", (str(len(serial_sounds)) + "\n").encode(encoding="ascii"))
-                            iface.write(serial_sounds)
-                            _log.debug("Sent %s", serial_sounds)
-                            _log.info("Serial ready!")
-                            last_upload_at = time.time()
-                            iface.reset_input_buffer()  # Maybe we got boot info again
-                            state = 1
-                        elif data == "~Soundboard ready":
-                            if state == 0:
-                                _log.info("Soundboard is already ready! Be sure to restart it if your local sound files have changed.")
-                            state = 2
-
-                        if not data.startswith("~"):
-                            client.thread_handle_serial_message(data, loop)
-                        data = ""
+                    if client.thread_done.is_set():
+                        break
+
+                    if chunk:
+                        protocol.feed(iface, chunk)
 
         except serial.serialutil.SerialException as exc:
             if not warned:
                 _log.warning("Can't talk to serial device. Retrying...")
                 warned = True
-            timeout = time.time() + 5
-            while time.time() < timeout and not client.thread_done:
-                time.sleep(0.5)
+            # Returns early if we're told to stop while waiting.
+            client.thread_done.wait(timeout=5)
 
 
 if __name__ == "__main__":
     global loop
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop = asyncio.get_event_loop()
-    loop.set_debug(True)
+    if os.environ.get("SERIALBOT_DEBUG"):
+        loop.set_debug(True)
     try:
         with SerialBot(port="COM3", baud=115200) as client:
             pass